@@ -1,100 +1,221 @@
 import argparse
+import asyncio
+import bisect
 import os
 import pathlib
-import shutil
+import re
 import subprocess
 import sys
 import tempfile
+from operator import attrgetter
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 
 DEFAULT_OUTPUT_PATH = os.getcwd()
 FFMPEG_BINARY = os.getenv("FFMPEG_PATH")
+# ffprobe ships alongside ffmpeg so look for it next to the ffmpeg binary unless told otherwise
+FFPROBE_BINARY = os.getenv("FFPROBE_PATH") or (
+    str(Path(FFMPEG_BINARY).with_name("ffprobe" + Path(FFMPEG_BINARY).suffix)) if FFMPEG_BINARY else None
+)
+# How far back from each start time to look for the keyframe a stream copied clip can start on
+KEYFRAME_SEARCH_WINDOW = 30
+# [[HH:][M]M:]SS, minutes and hours are optional but hours can only be given along with minutes
+TIME_POINT_PATTERN = re.compile(r"(?:(?:(?P<hours>\d{1,2}):)?(?P<minutes>\d{1,2}):)?(?P<seconds>\d{1,2})")
+MAX_TIME_SECTION = 60
 
 
-def ffmpeg_extract_clip(input_path, output_path, start_time, end_time=None):
-    cmd = [FFMPEG_BINARY, "-i", input_path, "-y", "-ss", "{:0.2f}".format(start_time)]
-    if end_time:
-        cmd.extend(["-t", "{:0.2f}".format(end_time - start_time)])
-    cmd.extend(["-async", "1", "-strict", "-2", output_path])
+# Extracts a clip by copying packets from the source, seeking to the nearest keyframe before the start time
+#   This avoids decoding and encoding altogether but is only accurate to the keyframe, pass precise=True to
+#   re-encode the clip and cut on the exact frame instead
+def ffmpeg_extract_clip(input_path, output_path, start_time, end_time=None, precise=False):
+    cmd = generate_extract_clip_cmd(input_path, output_path, start_time, end_time, precise)
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def ffmpeg_extract_clip_async(input_path, output_path, start_time, end_time=None, precise=False):
+    cmd = generate_extract_clip_cmd(input_path, output_path, start_time, end_time, precise)
+    return await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
 
-    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def generate_extract_clip_cmd(input_path, output_path, start_time, end_time=None, precise=False):
+    if precise:
+        cmd = [FFMPEG_BINARY, "-i", input_path, "-y", "-ss", "{:0.6f}".format(start_time)]
+    else:
+        cmd = [FFMPEG_BINARY, "-y", "-ss", "{:0.6f}".format(start_time), "-i", input_path]
+    if end_time:
+        cmd.extend(["-t", "{:0.6f}".format(end_time - start_time)])
+    if precise:
+        cmd.extend(["-async", "1", "-strict", "-2", output_path])
+    else:
+        cmd.extend(["-c", "copy", "-avoid_negative_ts", "make_zero", output_path])
+    return cmd
 
 
+# Merges clips with the concat demuxer, which copies packets instead of re-encoding them
+#   This is lossless but requires every clip to share codecs and parameters, which holds since all
+#   clips are extracted from the same source
 def ffmpeg_merge_clips(clips, output_path):
-    input_params = []
-    for clip in clips:
-        input_params.append("-i")
-        input_params.append(clip)
-    filter_param = generate_filter_param(len(clips))
-    merge_cmd = [FFMPEG_BINARY]
-    merge_cmd.extend(input_params)
-    merge_cmd.extend(['-y', '-filter_complex', '{}'.format(filter_param),
-                      '-map', '[v]', '-map', '[a]', output_path])
-    proc = subprocess.Popen(merge_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return proc
-
-
-# Generates argument string for filter parameter in the ffmpeg command to merge clips
-#   This is generated dynamically because it depends on the number of clips being merged
-def generate_filter_param(number_of_clips):
-    parameter = []
-    template1 = "[{}:v:0] [{}:a:0]"
-    template2 = "concat=n={}:v=1:a=1 [v] [a]"
-    [parameter.append(template1.format(n, n)) for n in range(number_of_clips)]
-    return " ".join(parameter) + " " + template2.format(number_of_clips)
+    list_file = Path(clips[0]).parent / "clips.txt"
+    with open(list_file, "w") as f:
+        f.writelines("file '{}'\n".format(escape_concat_path(clip)) for clip in clips)
+    return ffmpeg_concat(list_file, output_path)
+
+
+# Clips and merges in a single pass by listing the source once per interval in the concat demuxer, with
+#   inpoint/outpoint directives marking each interval, so no intermediate clips are ever written
+#   Packets are copied so like ffmpeg_extract_clip each clip starts on the keyframe before its start time, pass
+#   the source's keyframes to place each inpoint exactly on that keyframe
+#   Interval times count from the start of the video, inpoints are container timestamps so start_offset is added
+def ffmpeg_concat_intervals(input_path, intervals, output_path, list_file, keyframes=(), start_offset=0.0):
+    with open(list_file, "w") as f:
+        for interval in intervals:
+            start_time = snap_to_keyframe(interval.start_time.convert_to_seconds(), keyframes)
+            f.write("file '{}'\n".format(escape_concat_path(input_path)))
+            f.write("inpoint {:0.6f}\n".format(start_offset + start_time))
+            if interval.end_time:
+                f.write("outpoint {:0.6f}\n".format(start_offset + interval.end_time.convert_to_seconds()))
+    return ffmpeg_concat(list_file, output_path)
+
+
+# Paths in a concat list are single quoted, so any quote inside one has to close the quoting, be escaped and reopen it
+def escape_concat_path(path):
+    return str(path).replace("'", "'\\''")
+
+
+def ffmpeg_concat(list_file, output_path):
+    cmd = [FFMPEG_BINARY, "-y", "-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy", output_path]
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# Runs ffprobe over the source and returns its output, or None when the source could not be probed
+def run_ffprobe(input_path, args):
+    cmd = [FFPROBE_BINARY, "-v", "error"] + args + ["-of", "csv=p=0", input_path]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    return proc.stdout if proc.returncode == 0 else None
+
+
+# Returns whether the source has an audio stream, assuming it does when the source could not be probed
+def probe_has_audio(input_path):
+    output = run_ffprobe(input_path, ["-select_streams", "a", "-show_entries", "stream=index"])
+    return output is None or bool(output.strip())
+
+
+# Returns the timestamp the source's container starts at, which is what ffmpeg counts -ss from
+#   Packet timestamps and concat inpoints are in the container's own time base so they need shifting by it
+def probe_start_time(input_path):
+    output = run_ffprobe(input_path, ["-show_entries", "format=start_time"])
+    try:
+        return float(output.strip())
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+# Finds the video keyframes around each start time with a single ffprobe over the source
+#   Only packets from KEYFRAME_SEARCH_WINDOW seconds before each start time are read and nothing is decoded
+#   ffprobe stops reading before a window's end, so each window ends just after its start time to include a
+#   keyframe sitting exactly on it
+#   Returns the sorted keyframe times relative to start_offset, or an empty list when the source could not be probed
+def probe_keyframes(input_path, start_times, start_offset=0.0) -> List[float]:
+    read_intervals = ",".join(
+        "{:0.6f}%{:0.6f}".format(start_offset + max(start_time - KEYFRAME_SEARCH_WINDOW, 0),
+                                 start_offset + start_time + 0.5)
+        for start_time in start_times
+    )
+    output = run_ffprobe(input_path, ["-select_streams", "v:0", "-read_intervals", read_intervals,
+                                      "-show_entries", "packet=pts_time,flags"])
+    keyframes = set()
+    for line in (output or "").splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time != "N/A":
+            # Rounded to the microseconds ffprobe reports so a keyframe exactly on a start time still compares equal
+            keyframes.add(round(float(pts_time) - start_offset, 6))
+    return sorted(keyframes)
+
+
+# Returns the latest keyframe at or before the given time, or the time itself when no such keyframe is known
+def snap_to_keyframe(time, keyframes):
+    index = bisect.bisect_right(keyframes, time)
+    return keyframes[index - 1] if index else time
+
+
+def ffmpeg_extract_and_merge(input_path, intervals, output_path, audio=True):
+    filter_param = generate_trim_filter_param(intervals, audio)
+    cmd = [FFMPEG_BINARY, "-i", input_path, "-y", "-filter_complex", filter_param, "-map", "[v]"]
+    if audio:
+        cmd.extend(["-map", "[a]"])
+    cmd.append(output_path)
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# Generates argument string for filter parameter in the ffmpeg command to clip and merge in a single pass
+#   Each interval is trimmed out of the one input and the resulting streams are fed directly into concat
+#   Pass audio=False for sources without an audio stream so that only the video is trimmed and merged
+def generate_trim_filter_param(intervals, audio=True):
+    bounds = [(i.start_time.convert_to_seconds(), i.end_time.convert_to_seconds()) for i in intervals]
+    trims = ";".join(
+        f"[0:v]trim=start={start:0.2f}:end={end:0.2f},setpts=PTS-STARTPTS[v{n}]"
+        + (f";[0:a]atrim=start={start:0.2f}:end={end:0.2f},asetpts=PTS-STARTPTS[a{n}]" if audio else "")
+        for n, (start, end) in enumerate(bounds)
+    )
+    labels = "".join(f"[v{n}][a{n}]" if audio else f"[v{n}]" for n in range(len(bounds)))
+    outputs = "[v][a]" if audio else "[v]"
+    return f"{trims};{labels}concat=n={len(bounds)}:v=1:a={int(audio)}{outputs}"
 
 
 class TimePoint:
-    def __init__(self, time_endpoint_string):
-        time_sections = time_endpoint_string.split(":")
-        if len(time_sections) < 1 or len(time_sections) > 3:
+    __slots__ = ("seconds", "minutes", "hours", "_total")
+    seconds: int
+    minutes: int
+    hours: int
+    _total: int
+
+    def __init__(self, time_endpoint_string: str):
+        match = TIME_POINT_PATTERN.fullmatch(time_endpoint_string)
+        if not match:
             raise InvalidTimeIntervalException("Invalid string: must contain at least minutes and seconds ([M]M:SS)")
-        # A seconds value is required
-        self.seconds = TimePoint.parse_time_section(time_sections[-1])
-        # Minutes and hours are optional so initialize to zero then set if present
-        self.minutes = 0
-        self.hours = 0
-        if len(time_sections) >= 2:
-            self.minutes = TimePoint.parse_time_section(time_sections[-2])
-        if len(time_sections) == 3:
-            self.hours = TimePoint.parse_time_section(time_sections[0])
-
-    def convert_to_seconds(self):
-        return self.seconds + (self.minutes * 60) + (self.hours * 60 * 60)
-
-    @staticmethod
-    def parse_time_section(time_section_string, max_=60):
-        try:
-            time_duration = int(time_section_string)
-        except ValueError:
-            raise InvalidTimeDurationException(f"Value ({time_section_string}) is not a number")
-        if not (0 <= time_duration <= max_):
-            raise InvalidTimeDurationException(f"Value must be between 0 and ({max_})")
-        return time_duration
-
-    def __lt__(self, other_time_point):
-        return self.convert_to_seconds() < other_time_point.convert_to_seconds()
-
-    def __gt__(self, other_time_point):
-        return self.convert_to_seconds() > other_time_point.convert_to_seconds()
-
-    def __le__(self, other_time_point):
-        return self.convert_to_seconds() <= other_time_point.convert_to_seconds()
-
-    def __ge__(self, other_time_point):
-        return self.convert_to_seconds() >= other_time_point.convert_to_seconds()
-
-    def __eq__(self, other_time_point):
-        return self.convert_to_seconds() == other_time_point.convert_to_seconds()
-
-    def __repr__(self):
+        # A seconds value is required, minutes and hours are optional and default to zero
+        self.seconds = int(match["seconds"])
+        self.minutes = int(match["minutes"] or 0)
+        self.hours = int(match["hours"] or 0)
+        # The pattern only matches digits so the values can't be negative, just check the largest one
+        if max(self.hours, self.minutes, self.seconds) > MAX_TIME_SECTION:
+            raise InvalidTimeDurationException(f"Value must be between 0 and ({MAX_TIME_SECTION})")
+        # Time points are never modified after parsing so the total is computed once for sorting and comparisons
+        self._total = self.seconds + (self.minutes * 60) + (self.hours * 60 * 60)
+
+    def convert_to_seconds(self) -> int:
+        return self._total
+
+    def __lt__(self, other_time_point: "TimePoint") -> bool:
+        return self._total < other_time_point._total
+
+    def __gt__(self, other_time_point: "TimePoint") -> bool:
+        return self._total > other_time_point._total
+
+    def __le__(self, other_time_point: "TimePoint") -> bool:
+        return self._total <= other_time_point._total
+
+    def __ge__(self, other_time_point: "TimePoint") -> bool:
+        return self._total >= other_time_point._total
+
+    def __eq__(self, other_time_point: "TimePoint") -> bool:  # type: ignore[override]
+        return self._total == other_time_point._total
+
+    def __repr__(self) -> str:
         return "{:02d}:{:02d}:{:02d}".format(self.hours, self.minutes, self.seconds)
 
 
 class TimeInterval:
+    __slots__ = ("start_time", "end_time")
+    start_time: TimePoint
+    end_time: Optional[TimePoint]
+
     def __init__(self, time_interval_string: str):
+        end_time: Optional[str]
         if "-" in time_interval_string:
             start_time, end_time = time_interval_string.split("-")
         else:
@@ -104,64 +225,128 @@ class TimeInterval:
         self.start_time = TimePoint(start_time)
         self.end_time = TimePoint(end_time) if end_time else None
 
-    def __len__(self):
+    def __len__(self) -> int:
         if self.end_time:
             return self.end_time.convert_to_seconds() - self.start_time.convert_to_seconds()
         return 0
 
-    def __repr__(self):
+    def __repr__(self) -> str:
         if not self.end_time:
             return "{}".format(self.start_time)
         return "{}-{}".format(self.start_time, self.end_time)
 
 
 # Ensure that intervals do not overlap
+#   Intervals must already be sorted by start time, so each one only needs comparing with the next
 def validate_intervals(intervals):
-    if intervals:
-        current_interval_index = 0
-        while current_interval_index < len(intervals)-1:
-            current_end = intervals[current_interval_index].end_time
-            next_start = intervals[current_interval_index+1].start_time
-            if current_end and current_end >= next_start:
-                raise InvalidTimeIntervalException("Time intervals overlap")
-            current_interval_index += 1
+    for current, following in zip(intervals, intervals[1:]):
+        if current.end_time and current.end_time._total >= following.start_time._total:
+            raise InvalidTimeIntervalException("Time intervals overlap")
 
 
-def read_proc_stdout(proc, message=None):
+# ffmpeg's output is not used so it is discarded at the source rather than read back line by line
+def wait_for_proc(proc, message=None):
     if message:
         print(message)
-    while True:
-        # Reading stderr and not stdout because that's where ffmpeg is writing its output to
-        line = proc.stderr.readline()
-        if line == b'' and proc.poll() is not None:
-            break
+    return check_returncode(proc.wait())
+
+
+# ffmpeg's output is discarded so its exit status is the only sign that it failed
+def check_returncode(returncode):
+    if returncode != 0:
+        raise FfmpegFailedException(f"ffmpeg exited with status {returncode}")
+    return returncode
+
+
+async def extract_clip(input_path, clip_path, interval, precise=False):
+    proc = await ffmpeg_extract_clip_async(
+        input_path,
+        clip_path,
+        interval.start_time.convert_to_seconds(),
+        interval.end_time.convert_to_seconds() if interval.end_time else None,
+        precise
+    )
+    return check_returncode(await proc.wait())
+
+
+# Runs one ffmpeg per clip, at most max_procs at a time, and waits for all of them on a single event loop
+#   rather than blocking a thread per process
+async def extract_clips_concurrently(input_path, clips, intervals, precise, max_procs):
+    limit = asyncio.Semaphore(max_procs)
+    processed = 0
+
+    async def extract(clip, interval):
+        nonlocal processed
+        async with limit:
+            await extract_clip(input_path, clip, interval, precise)
+        processed += 1
+        print("Processed subclip {} out of {}".format(processed, len(clips)))
+
+    # Let every ffmpeg finish before reporting a failure so none is left running once the event loop closes
+    results = await asyncio.gather(*(extract(clip, interval) for clip, interval in zip(clips, intervals)),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
 
 
-def clip_video(filename: Path, intervals: List[TimeInterval], output_path: Path):
-    intervals = sorted(intervals, key=lambda t: t.start_time.convert_to_seconds())
+def clip_video(filename: Path, intervals: List[TimeInterval], output_path: Path, precise: bool = False):
+    intervals = sorted(intervals, key=attrgetter("start_time._total"))
     print("Intervals to clip {}".format(intervals))
 
     validate_intervals(intervals)
 
-    tmpdir = tempfile.TemporaryDirectory()
-    clips = []
-    for i, interval in enumerate(intervals):
-        clip_filename = Path(f"{tmpdir.name}/tmp{i}{filename.suffix}")
-        clips.append(clip_filename.absolute())
+    # A frame accurate cut has to re-encode, when every interval is bounded the whole job can be done by one
+    #   ffmpeg so that the source is decoded and encoded only once
+    if precise and all(interval.end_time for interval in intervals):
+        proc = ffmpeg_extract_and_merge(filename, intervals, output_path, probe_has_audio(filename))
+        wait_for_proc(proc, "Clipping and merging {} subclips".format(len(intervals)))
+        print("Result saved to {}".format(output_path))
+        return
+
+    # Stream copied clips can only start on a keyframe, so find them up front and start each clip exactly on one
+    #   rather than leaving every ffmpeg to work it out on its own
+    #   Keyframes are relative to the container start, the same as -ss and the interval times
+    if precise:
+        start_offset, keyframes = 0.0, []
+    else:
+        start_offset = probe_start_time(filename)
+        keyframes = probe_keyframes(filename, [i.start_time.convert_to_seconds() for i in intervals], start_offset)
+
+    # A single clip needs no merging so it is extracted straight to the output
+    if len(intervals) == 1:
+        print("Processing subclip 1 out of 1")
         proc = ffmpeg_extract_clip(
             filename,
-            clip_filename,
-            interval.start_time.convert_to_seconds(),
-            interval.end_time.convert_to_seconds() if interval.end_time else None
+            output_path,
+            snap_to_keyframe(intervals[0].start_time.convert_to_seconds(), keyframes),
+            intervals[0].end_time.convert_to_seconds() if intervals[0].end_time else None,
+            precise
         )
-        read_proc_stdout(proc, "Processing subclip {} out of {}".format(i+1, len(intervals)))
-    # If there are multiple clips, merge them
-    # TODO: should make this optional (--merge defaulting to True)
-    if len(clips) > 1:
-        proc = ffmpeg_merge_clips(clips, output_path)
-        read_proc_stdout(proc, "Merging subclips")
-    else:  # Only one interval parameter was passed so the only clip is the output
-        shutil.move(clips[0], output_path)
+        wait_for_proc(proc)
+        print("Result saved to {}".format(output_path))
+        return
+
+    tmpdir = tempfile.TemporaryDirectory()
+    # Stream copied clips are cut and merged straight from the source, only the concat list touches the disk
+    if not precise:
+        list_file = os.path.join(tmpdir.name, "intervals.txt")
+        proc = ffmpeg_concat_intervals(filename, intervals, output_path, list_file, keyframes, start_offset)
+        wait_for_proc(proc, "Clipping and merging {} subclips".format(len(intervals)))
+        print("Result saved to {}".format(output_path))
+        return
+
+    # The temporary directory is always an absolute path so the clip paths need no resolving
+    tmp = tmpdir.name
+    suffix = filename.suffix
+    clips = [os.path.join(tmp, f"tmp{i}{suffix}") for i in range(len(intervals))]
+    # Re-encoding is CPU bound and each subclip is independent of the others so extract them concurrently,
+    #   bounded by the number of cores to avoid oversubscribing the machine
+    max_procs = min(len(intervals), os.cpu_count() or 1)
+    asyncio.run(extract_clips_concurrently(filename, clips, intervals, precise, max_procs))
+    # TODO: should make merging optional (--merge defaulting to True)
+    proc = ffmpeg_merge_clips(clips, output_path)
+    wait_for_proc(proc, "Merging subclips")
     print("Result saved to {}".format(output_path))
 
 
@@ -197,7 +382,7 @@ def process_arguments(args):
     if args.intervals:
         input_path = get_input_path(args.input_file)
         output_path = get_output_path(input_path, args.output_file)
-        clip_video(input_path, args.intervals, output_path)
+        clip_video(input_path, args.intervals, output_path, args.precise)
     elif args.interval_file:
         return "Not supported yet"
     else:
@@ -219,13 +404,18 @@ def create_arg_parser():
     group.add_argument("-f", "--interval_file", nargs="?", help="file containing one interval per line")
     arg_parser.add_argument("-o", "--output_file", nargs="?", default=".",
                             help="file path for the resulting video file")
+    arg_parser.add_argument("-p", "--precise", action="store_true",
+                            help="re-encode to cut on the exact frame instead of the nearest keyframe")
     return arg_parser
 
 
 class ApplicationException(Exception):
     def __init__(self, msg=None):
-        print(f"{self.__class__.__name__} {'- ' + msg if msg else ''}")
-        sys.exit(1)
+        super().__init__(msg)
+        self.msg = msg
+
+    def __str__(self):
+        return f"{self.__class__.__name__} {'- ' + self.msg if self.msg else ''}"
 
 
 class InputFileNotFoundException(ApplicationException):
@@ -248,6 +438,10 @@ class MissingFfmpegLocation(ApplicationException):
     pass
 
 
+class FfmpegFailedException(ApplicationException):
+    pass
+
+
 def _validate_ffmpeg_path():
     if FFMPEG_BINARY and pathlib.Path(FFMPEG_BINARY).exists():
         return True
@@ -255,13 +449,17 @@ def _validate_ffmpeg_path():
 
 
 def run():
-    _validate_ffmpeg_path()
     arg_parser = create_arg_parser()
     try:
+        _validate_ffmpeg_path()
         process_arguments(arg_parser.parse_args())
-    except Exception as e:
+    except ApplicationException as e:
         print(e)
         sys.exit(1)
+    # Anything else is a bug rather than bad input, so name the exception instead of printing only its message
+    except Exception as e:
+        print(f"Unexpected error: {e.__class__.__name__} - {e}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":